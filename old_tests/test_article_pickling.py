@@ -0,0 +1,73 @@
+import multiprocessing
+import pickle
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+
+from bs4 import Tag
+
+from prepress import Article, parse_html
+
+
+def make_article():
+    article = Article()
+    article.title = "Pickled"
+    article.id = "1"
+    article.content = parse_html(
+        '<p>a &lt;b&gt; <em class="x y">c</em><br/><!--note--></p>\n<ul><li>d</li></ul>'
+    )
+    # a tag built without a builder isn't a void element, even though <link> usually is
+    article.content.p.append(Tag(name="link", attrs={"href": "file://e.pdf"}))
+    # the same as filter_articles does with a postscript
+    article.postscript = parse_html("<p>ps</p>")
+    footer = article.content.new_tag("footer")
+    footer.append(article.postscript)
+    article.content.append("\n")
+    article.content.append(footer)
+    return article
+
+
+def tree_shape(soup):
+    return [
+        (
+            (node.name, node.attrs, node.can_be_empty_element, len(node.contents))
+            if isinstance(node, Tag)
+            else (type(node), str(node))
+        )
+        for node in soup.descendants
+    ]
+
+
+def content_in_worker(article):
+    return str(article.content)
+
+
+class TestArticlePickling(unittest.TestCase):
+
+    def test_round_trip(self):
+        article = make_article()
+        unpickled = pickle.loads(pickle.dumps(article))
+
+        self.assertEqual(str(unpickled.content), str(article.content))
+        self.assertEqual(tree_shape(unpickled.content), tree_shape(article.content))
+        self.assertIn('<link href="file://e.pdf"></link>', str(unpickled.content))
+
+    def test_postscript_not_duplicated(self):
+        article = make_article()
+        unpickled = pickle.loads(pickle.dumps(article))
+
+        self.assertEqual(str(unpickled.content).count("ps"), 1)
+        self.assertEqual(len(unpickled.content.find_all("footer")), 1)
+        self.assertIsNone(unpickled.postscript)
+
+    def test_round_trip_without_fork(self):
+        article = make_article()
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            content = executor.submit(content_in_worker, article).result()
+
+        self.assertEqual(content, str(article.content))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,22 +1,27 @@
 import argparse
+import contextlib
 import hashlib
-import html
 import os
 import os.path
 import re
 import shutil
 import string
 import subprocess
-import urllib.error
 import urllib.parse
-import urllib.request
-from typing import Callable, Dict, List
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
 from xml.etree import ElementTree
 from xml.etree.ElementTree import Element, SubElement
 
 import bs4
 import colorama
 import pylatex
+import urllib3
 from bs4 import BeautifulSoup, Tag
 from PIL import Image
 
@@ -28,10 +33,10 @@ from plugins.syntax_highlighting import (
 )
 from util import (
     LINE_SEPARATOR,
-    VERBATIM_TAGS,
+    cached_is_link_component,
+    cached_keep_verbatim,
+    find_text_tags,
     html_escape,
-    is_link_component,
-    keep_verbatim,
 )
 
 # The directory to store generated assets. Can be changed by command line argument.
@@ -47,6 +52,10 @@ CURRENT_DIR: str
 DPI = 300
 IMAGE_WIDTH_DEFAULT = 1138
 USER_AGENT = "curl/7.61"  # 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/113.0'
+# Number of images to download at once
+DOWNLOAD_WORKERS = 8
+# Shared by all requests, so that requests to the same host reuse connections
+HTTP = urllib3.PoolManager(maxsize=DOWNLOAD_WORKERS, headers={"User-Agent": USER_AGENT})
 
 # Name of category for approved articles
 APPROVED_CATEGORY = "Editor okayed"
@@ -55,9 +64,25 @@ XML_NS = {
     "content": "http://purl.org/rss/1.0/modules/content/",
     "wp": "http://wordpress.org/export/1.2/",
 }
+# Namespaced tags we read data from, resolved ahead of time to the names ElementTree uses,
+# so lookups don't need to expand a prefix using XML_NS every time
+POST_ID_TAG = f"{{{XML_NS['wp']}}}post_id"
+POST_META_TAG = f"{{{XML_NS['wp']}}}postmeta"
+META_KEY_TAG = f"{{{XML_NS['wp']}}}meta_key"
+META_VALUE_TAG = f"{{{XML_NS['wp']}}}meta_value"
+CONTENT_TAG = f"{{{XML_NS['content']}}}encoded"
+
+# Only the image container is needed from Imgur's embed page
+IMGUR_IMAGE_STRAINER = bs4.SoupStrainer(id="image")
+
+
+# Strips characters that are not safe to use in asset filenames
+NON_WORD_REGEX = re.compile(r"\W")
 
 
 class Article:
+    # many articles are alive at once, so skip the per-instance __dict__
+    __slots__ = ("author", "title", "subtitle", "id", "content", "postscript", "_slug")
 
     def __init__(self):
         self.author = ""
@@ -67,23 +92,45 @@ class Article:
         # content and postscript is stored as a beautiful soup tree
         self.content: BeautifulSoup = None
         self.postscript: BeautifulSoup = None
+        # the slug, along with the title and id it was generated from
+        self._slug: Tuple[str, str, str] = None
+
+    def __getstate__(self) -> dict:
+        state = {name: getattr(self, name) for name in self.__slots__}
+        if state["content"] is not None:
+            state["content"] = flatten_soup(state["content"])
+        # filter_articles moves the postscript into the content's <footer>, so the content already
+        # carries it and the emptied postscript tree isn't sent along
+        state["postscript"] = None
+        return state
+
+    def __setstate__(self, state: dict):
+        if state["content"] is not None:
+            state["content"] = unflatten_soup(state["content"])
+        for name, value in state.items():
+            setattr(self, name, value)
 
     def is_secondary_article(self) -> bool:
         """Check, based on our naming conventions, if the article is a secondary."""
         return self.title.strip().startswith("^") or self.title.strip().endswith("^")
 
     def get_article_slug(self) -> str:
+        # every image and piece of latex asks for the slug, so only regenerate it when the title
+        # or id has changed
+        if self._slug is not None and self._slug[:2] == (self.title, self.id):
+            return self._slug[2]
         # generate a slug by trimming the title, replacing non-ascii chars, and replacing spaces
         # plus article id to prevent article title collisions
-        file_prefix = re.sub(
-            r"\W",
+        file_prefix = NON_WORD_REGEX.sub(
             "",
             self.title[0:10]
             .encode("ascii", errors="ignore")
             .decode()
             .replace(" ", "_"),
         )
-        return file_prefix + "_" + self.id
+        slug = file_prefix + "_" + self.id
+        self._slug = (self.title, self.id, slug)
+        return slug
 
     def get_image_location(self, file: str, index: int) -> str:
         article_slug = self.get_article_slug()
@@ -145,82 +192,162 @@ def is_for_issue(article_tag: Element, issue_num: str) -> bool:
     return has_correct_tag and has_approval
 
 
+"""Maps Wordpress shortcodes to the HTML tags they are converted to before parsing."""
+SHORTCODE_TAGS = {
+    "caption": "caption",
+    "emphasis 1": "em",
+    "emphasis 2": "em2",
+    "emphasis 3": "em3",
+    "emphasis 4": "em4",
+    "em1": "em",
+    "em2": "em2",
+    "em3": "em3",
+    "em4": "em4",
+    "stress 1": "strong",
+    "stress 2": "strong2",
+    "str1": "strong",
+    "str2": "strong2",
+    "article": "aref",
+    "aref": "aref",
+    "math": "imath",
+}
+# Matches any shortcode. Opening caption shortcodes carry attributes, so they are matched separately.
+SHORTCODE_REGEX = re.compile(
+    r"\[(?:(?P<caption>caption[^\]]*)|(?P<close>/?)(?P<name>{}))\]".format(
+        "|".join(re.escape(name) for name in SHORTCODE_TAGS)
+    )
+)
+
+
+def replace_shortcode(match: re.Match) -> str:
+    if match["caption"] is not None:
+        return f"<{match['caption']}>"
+    return f"<{match['close']}{SHORTCODE_TAGS[match['name']]}>"
+
+
 def preprocess_html(html: str) -> str:
     """Used to process content strings before they are parsed as HTML"""
-    subs = [
-        (r"\[caption([^\]]*)\]", r"<caption\1>"),
-        (r"\[/caption\]", "</caption>"),
-        (r"\[emphasis 1\]", r"<em>"),
-        (r"\[/emphasis 1\]", "</em>"),
-        (r"\[emphasis 2\]", r"<em2>"),
-        (r"\[/emphasis 2\]", "</em2>"),
-        (r"\[emphasis 3\]", r"<em3>"),
-        (r"\[/emphasis 3\]", "</em3>"),
-        (r"\[emphasis 4\]", r"<em4>"),
-        (r"\[/emphasis 4\]", "</em4>"),
-        (r"\[em1\]", r"<em>"),
-        (r"\[/em1\]", "</em>"),
-        (r"\[em2\]", r"<em2>"),
-        (r"\[/em2\]", "</em2>"),
-        (r"\[em3\]", r"<em3>"),
-        (r"\[/em3\]", "</em3>"),
-        (r"\[em4\]", r"<em4>"),
-        (r"\[/em4\]", "</em4>"),
-        (r"\[stress 1\]", r"<strong>"),
-        (r"\[/stress 1\]", "</strong>"),
-        (r"\[stress 2\]", r"<strong2>"),
-        (r"\[/stress 2\]", "</strong2>"),
-        (r"\[str1\]", r"<strong>"),
-        (r"\[/str1\]", "</strong>"),
-        (r"\[str2\]", r"<strong2>"),
-        (r"\[/str2\]", "</strong2>"),
-        (r"\[article\]", r"<aref>"),
-        (r"\[/article\]", "</aref>"),
-        (r"\[aref\]", r"<aref>"),
-        (r"\[/aref\]", "</aref>"),
-        (r"\[math\]", r"<imath>"),
-        (r"\[/math\]", "</imath>"),
-    ]
-    for pattern, sub in subs:
-        html = re.sub(pattern, sub, html)
-    return html
-
-
-def filter_articles(tree: ElementTree, issue_num: str) -> List[Article]:
-    """Given an ElementTree parsed from an XML dump, returns a list
-    of Article instances containing all the articles tagged with issue_num.
+    return SHORTCODE_REGEX.sub(replace_shortcode, html)
+
+
+def parse_html(markup: str) -> BeautifulSoup:
+    """Parses an article's HTML. This uses html.parser rather than lxml, since lxml drops any text
+    after a bare "<" (e.g. "if x<y") and moves tags around to make the markup valid HTML.
+    """
+    return BeautifulSoup(markup, "html.parser")
+
+
+def flatten_soup(soup: BeautifulSoup) -> list:
+    """Flattens a parsed tree into a list of its nodes in document order, so that it can be sent to
+    another process. bs4 pickles a soup by reparsing its markup, which doesn't give back the same
+    tree, and pickling a tag directly recurses through the whole document.
+
+    The first item is the number of children the soup has. Tags are stored along with their number
+    of children, strings along with their type.
+    """
+    nodes: list = [len(soup.contents)]
+    for node in soup.descendants:
+        if isinstance(node, Tag):
+            nodes.append(
+                (
+                    node.name,
+                    dict(node.attrs),
+                    node.can_be_empty_element,
+                    node.interesting_string_types,
+                    node.hidden,
+                    len(node.contents),
+                )
+            )
+        else:
+            nodes.append((type(node), str(node)))
+    return nodes
+
+
+def unflatten_soup(nodes: list) -> BeautifulSoup:
+    """Rebuilds a tree flattened by flatten_soup."""
+    soup = BeautifulSoup("", "html.parser")
+    # tags that still have children to be added, along with how many they have left
+    open_tags: List[Tuple[Tag, int]] = [(soup, nodes[0])]
+    for node in nodes[1:]:
+        while open_tags[-1][1] == 0:
+            open_tags.pop()
+        parent, children_left = open_tags.pop()
+        open_tags.append((parent, children_left - 1))
+
+        if len(node) == 2:
+            string_type, text = node
+            parent.append(string_type(text))
+        else:
+            name, attrs, can_be_empty, string_types, hidden, child_count = node
+            tag = Tag(
+                name=name,
+                attrs=attrs,
+                can_be_empty_element=can_be_empty,
+                interesting_string_types=string_types,
+            )
+            tag.hidden = hidden
+            parent.append(tag)
+            open_tags.append((tag, child_count))
+    return soup
+
+
+def iter_items(source_path: str) -> Iterator[Element]:
+    """Streams the <item> tags out of the XML dump at source_path. Each item is cleared and
+    removed from the tree once the caller is done with it, so the whole dump is never held
+    in memory at once.
+    """
+    # the elements whose start tags we've seen, but not their end tags
+    open_elements: List[Element] = []
+    for event, elem in ElementTree.iterparse(source_path, events=("start", "end")):
+        if event == "start":
+            open_elements.append(elem)
+            continue
+
+        open_elements.pop()
+        if elem.tag != "item":
+            continue
+
+        yield elem
+        elem.clear()
+        if open_elements:
+            open_elements[-1].remove(elem)
+
+
+def filter_articles(source_path: str, issue_num: str) -> List[Article]:
+    """Given the location of an XML dump, returns a list of Article instances
+    containing all the articles tagged with issue_num.
     """
-    root = tree.getroot()
     articles: List[Article] = []
-    article_tags = root.findall(".//item")
-    for article_tag in article_tags:
+    for article_tag in iter_items(source_path):
         if not is_for_issue(article_tag, issue_num):
             continue
         article = Article()
-        # possible optimization, instead of calling find several times,
-        # loop through tag children once and parse out data as we run into it
-        article.title = article_tag.find("title").text or "[no title]"
-        article.id = article_tag.find("wp:post_id", XML_NS).text
-        # go through post meta tags
-        post_meta_tags = article_tag.findall("wp:postmeta", XML_NS)
-        for post_meta_tag in post_meta_tags:
-            meta_key = post_meta_tag.find("wp:meta_key", XML_NS).text
-            meta_value = post_meta_tag.find("wp:meta_value", XML_NS).text
-
-            if meta_key == "mn_subtitle":
-                article.subtitle = meta_value
-            elif meta_key == "mn_author":
-                article.author = meta_value
-            elif meta_key == "mn_postscript":
-                article.postscript = BeautifulSoup(meta_value, "html.parser")
-        # we will post process this later
-        article_text_content = article_tag.find("content:encoded", XML_NS).text
+        article_text_content = None
+        # loop through the tag's children once, and parse out data as we run into it
+        for child in article_tag:
+            if child.tag == "title":
+                article.title = child.text or "[no title]"
+            elif child.tag == POST_ID_TAG:
+                article.id = child.text
+            elif child.tag == POST_META_TAG:
+                meta_key = child.find(META_KEY_TAG).text
+                meta_value = child.find(META_VALUE_TAG).text
+
+                if meta_key == "mn_subtitle":
+                    article.subtitle = meta_value
+                elif meta_key == "mn_author":
+                    article.author = meta_value
+                elif meta_key == "mn_postscript":
+                    article.postscript = parse_html(meta_value)
+            elif child.tag == CONTENT_TAG:
+                # we will post process this later
+                article_text_content = child.text
         if article_text_content is None:
             article_text_content = ""
 
         article_text_content = preprocess_html(article_text_content)
 
-        article.content = BeautifulSoup(article_text_content, "html.parser")
+        article.content = parse_html(article_text_content)
         # TODO: instead of appending to content, process postscript separately
         if article.postscript is not None:
             postscript_wrap = article.content.new_tag("footer")
@@ -234,31 +361,53 @@ def filter_articles(tree: ElementTree, issue_num: str) -> List[Article]:
 def replace_text_with_tag(
     sub_text: str, repl_tag: Tag, text_tag: bs4.NavigableString, article: Article
 ) -> bs4.NavigableString:
-    # if we can't find the parent, assume it's just the document
-    parent: Tag
-    if text_tag.parent == None or text_tag.parent.name == "[document]":
-        parent = article.content
-    else:
-        parent = text_tag.parent
-    tag_idx = parent.contents.index(text_tag)
     # replace the matched text with a tag
     begin, _, end = text_tag.partition(sub_text)
     # convert these strings to tags
     begin = bs4.NavigableString(begin)
     end = bs4.NavigableString(end)
+    # insert relative to the text tag itself, rather than looking up its index in the parent
+    text_tag.insert_after(end)
+    text_tag.insert_after(repl_tag)
     text_tag.replace_with(begin)
-    parent.insert(tag_idx + 1, repl_tag)
-    parent.insert(tag_idx + 2, end)
     return end
 
 
-def convert_imgur_embeds(article: Article) -> Article:
-    """Converts Imgur embeds of the form `[embed]https://imgur.com/...[/embed]` into image tags.
-    It does so by scraping the Imgur embed page and retrieving the image URL of the first image it sees.
-    As a result, we don't (yet) support multiple images.
+"""A TextPass takes the text of a single non-verbatim text tag, along with the article it belongs
+to, and returns the text that should replace it.
+"""
+TextPass = Callable[[str, Article], str]
+
+
+def run_text_passes(article: Article, passes: Sequence[TextPass]) -> Article:
+    """Applies each pass in order to every non-verbatim text tag, in a single traversal of the
+    article content.
     """
-    imgur_url_regex = re.compile(
-        r"""
+    text_tag: bs4.NavigableString
+    is_verbatim = cached_keep_verbatim()
+    for text_tag in find_text_tags(article.content):
+        if is_verbatim(text_tag):
+            continue
+
+        new_tag = str(text_tag)
+        for text_pass in passes:
+            new_tag = text_pass(new_tag, article)
+        text_tag.replace_with(new_tag)
+    return article
+
+
+def text_passes(*passes: TextPass) -> Callable[[Article], Article]:
+    """Combines several text passes into one post-process step that traverses the article once."""
+
+    def run(article: Article) -> Article:
+        return run_text_passes(article, passes)
+
+    run.__name__ = "+".join(text_pass.__name__ for text_pass in passes)
+    return run
+
+
+IMGUR_URL_REGEX = re.compile(
+    r"""
     (?:https?:)?//
     (?:i\.)?                  # Don't care if the URL uses the i.imgur.com subdomain
     imgur.com/
@@ -267,44 +416,54 @@ def convert_imgur_embeds(article: Article) -> Article:
     .?                        # Don't care about any extraneous characters
     (?P<ext>\.\w+)?           # Match any potential file extensions
     """,
-        re.VERBOSE | re.ASCII,
-    )
-    imgur_regex = re.compile(
-        rf"""\[embed\]{imgur_url_regex.pattern}\[/embed\]""", re.VERBOSE | re.ASCII
-    )
-    imgur_url_templ = "https://i.imgur.com/{hash}{ext}"
+    re.VERBOSE | re.ASCII,
+)
+IMGUR_EMBED_REGEX = re.compile(
+    rf"""\[embed\]{IMGUR_URL_REGEX.pattern}\[/embed\]""", re.VERBOSE | re.ASCII
+)
+IMGUR_URL_TEMPLATE = "https://i.imgur.com/{hash}{ext}"
+
 
-    for text_tag in article.content.find_all(string=True):
-        if keep_verbatim(text_tag):
+def convert_imgur_embeds(article: Article) -> Article:
+    """Converts Imgur embeds of the form `[embed]https://imgur.com/...[/embed]` into image tags.
+    It does so by scraping the Imgur embed page and retrieving the image URL of the first image it sees.
+    As a result, we don't (yet) support multiple images.
+    """
+    is_verbatim = cached_keep_verbatim()
+    for text_tag in find_text_tags(article.content):
+        # cheap check to skip the regex for the vast majority of text
+        if "[embed]" not in text_tag or is_verbatim(text_tag):
             continue
 
-        for match in imgur_regex.finditer(text_tag):
-            img_url = imgur_url_templ.format(**match.groupdict())
+        for match in IMGUR_EMBED_REGEX.finditer(text_tag):
+            img_url = IMGUR_URL_TEMPLATE.format(**match.groupdict())
             if match["ext"] is None:
                 # No file extension, have to scrape
                 try:
-                    with urllib.request.urlopen(
+                    resp = HTTP.request(
+                        "GET",
                         "https://imgur.com/{scheme}{hash}/embed?pub=true".format(
                             **match.groupdict(default="")
-                        )
-                    ) as resp:
-                        if resp.getcode() != 200:
-                            raise ValueError("Gallery does not exist")
-                        html_text = resp.read()
-                        imgur_soup = BeautifulSoup(html_text, "html.parser")
+                        ),
+                    )
+                    if resp.status != 200:
+                        raise ValueError("Gallery does not exist")
+                    imgur_soup = BeautifulSoup(
+                        resp.data, "html.parser", parse_only=IMGUR_IMAGE_STRAINER
+                    )
                     img_el = imgur_soup.find(id="image")
                     if img_el is None:
                         raise ValueError(
                             "Could not find image source in returned webpage"
                         )
-                except (urllib.error.HTTPError, ValueError) as e:
+                except (urllib3.exceptions.HTTPError, ValueError) as e:
                     print(f"Error downloading Imgur gallery {match[0]}. Reason: {e}")
                     input("[Enter] to continue...")
                     continue
                 # Filter url given in content
                 img_el = img_el.find("img", class_="post")
-                img_hash = imgur_url_regex.match(img_el["src"])
-                img_url = imgur_url_templ.format(**img_hash.groupdict())
+                img_hash = IMGUR_URL_REGEX.match(img_el["src"])
+                img_url = IMGUR_URL_TEMPLATE.format(**img_hash.groupdict())
             # Replace embed code with an actual img tag
             img_tag = article.content.new_tag("img", src=img_url)
             text_tag = replace_text_with_tag(match[0], img_tag, text_tag, article)
@@ -316,21 +475,48 @@ def resize_image(image_path: str):
     """Resizes the image at image_path to a standard size so they don't import
     into InDesign at giant size.
     """
-    image: Image.Image = Image.open(image_path)
-    w = image.width
-    h = image.height
-    scale_factor = IMAGE_WIDTH_DEFAULT / w
-    image.resize((int(w * scale_factor), int(h * scale_factor))).save(
-        image_path, dpi=(DPI, DPI)
-    )
+    image: Image.Image
+    with Image.open(image_path) as image:
+        w = image.width
+        h = image.height
+        scale_factor = IMAGE_WIDTH_DEFAULT / w
+        size = (int(w * scale_factor), int(h * scale_factor))
+        # JPEGs can be decoded at a fraction of their full size, which is much faster than
+        # decoding every pixel just to throw most of them away. No-op for other formats
+        image.draft(None, size)
+        # when shrinking, reduce by a whole factor first, then resample the rest of the way
+        resized = image.resize(size, reducing_gap=3.0)
+    resized.save(image_path, dpi=(DPI, DPI))
+
+
+def download_image(url: str, local_path: str):
+    """Downloads the image at url to local_path, and resizes it if it isn't an SVG."""
+    response = HTTP.request("GET", url, preload_content=False)
+    try:
+        if response.status >= 400:
+            raise urllib3.exceptions.HTTPError(
+                f"HTTP Error {response.status}: {response.reason}"
+            )
+        # stream to disk in chunks, rather than holding the whole image in memory
+        with open(local_path, "wb") as f:
+            shutil.copyfileobj(response, f, length=1 << 16)
+    finally:
+        response.release_conn()
+    # resize the image to a reasonable size
+    if response.headers.get("Content-Type") != "image/svg+xml":
+        resize_image(local_path)
 
 
-def download_images(article: Article) -> Article:
-    """Looks through the article content for image tags and downloads them locally and saves
-    them as an asset. Then, it changes the link text to point to the local copy instead of
-    the web copy.
-    """
+# Images being downloaded, mapped to the image tag, url and local path of each download
+ImageDownloads = Dict[Future, Tuple[Tag, str, str]]
+
+
+def queue_image_downloads(
+    article: Article, executor: ThreadPoolExecutor
+) -> ImageDownloads:
+    """Starts downloading each of the article's images on executor."""
     img_tag: Tag
+    downloads: ImageDownloads = {}
     for index, img_tag in enumerate(article.content.find_all("img")):
         # try block because sometimes images without sources get added (don't ask me why)
         try:
@@ -340,24 +526,44 @@ def download_images(article: Article) -> Article:
         filename = os.path.basename(urllib.parse.urlparse(url).path)
         local_path = article.get_image_location(filename, index)
         print(f"Downloading {local_path}\t{url}", flush=True)
+        future = executor.submit(download_image, url, local_path)
+        downloads[future] = (img_tag, url, local_path)
+    return downloads
+
+
+def finish_image_downloads(downloads: ImageDownloads):
+    """Waits for queued downloads, and points each image tag at its local copy."""
+    for future in as_completed(downloads):
+        img_tag, url, local_path = downloads[future]
         try:
-            request = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
-            with urllib.request.urlopen(request) as response:
-                with open(local_path, "wb") as f:
-                    f.write(response.read())
-                # resize the image to a reasonable size
-                if response.headers["Content-Type"] != "image/svg+xml":
-                    resize_image(local_path)
+            future.result()
             # InDesign recognizes <link href=""> tags for images
             img_tag.name = "link"
             img_tag.attrs["href"] = "file://" + local_path
-        except urllib.error.HTTPError as e:
+        except urllib3.exceptions.HTTPError as e:
             print(f"Error downloading image {url}. Reason: {e}")
             input("[Enter] to continue...")
         except FileNotFoundError as e:
             print(f"Error downloading image {url}. Reason: {e}")
             input("[Enter] to continue...")
-    return article
+
+
+def download_images(articles: List[Article]):
+    """Looks through the content of every article for image tags and downloads them locally and
+    saves them as an asset. Then, it changes the link text to point to the local copy instead of
+    the web copy.
+    """
+    # Downloads are network-bound, so run them side by side, with the whole issue sharing one pool
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        issue_downloads: List[Tuple[Article, ImageDownloads]] = []
+        for article in articles:
+            with report_article_errors(article, download_images):
+                issue_downloads.append(
+                    (article, queue_image_downloads(article, executor))
+                )
+        for article, downloads in issue_downloads:
+            with report_article_errors(article, download_images):
+                finish_image_downloads(downloads)
 
 
 class Preview(pylatex.base_classes.Environment):
@@ -387,60 +593,131 @@ def compile_latex_str(latex: str, filename: str, display: bool = False):
     print(f"{filename}\t{latex}", flush=True)
 
 
-def compile_latex(article: Article) -> Article:
-    """Looks through the article content for embedded LaTeX and compiles it into
-    PDFs, and adds the proper tags so they show up on import.
+# matches LaTeX inside \( \) or \[ \]
+LATEX_REGEX = re.compile(r"\\[([]([\s\S]+?)\\[)\]]")
+
+
+# Text tags containing LaTeX, along with the LaTeX found in each
+LatexMatches = List[Tuple[bs4.NavigableString, List[re.Match]]]
+
+
+def find_latex(article: Article) -> Tuple[LatexMatches, Dict[str, str]]:
+    """Finds the LaTeX in the article, along with the filename each unique piece of LaTeX is
+    compiled to.
     """
     text_tag: bs4.NavigableString
-    # matches LaTeX inside one or two dollar signs
-    inline_regex = r"\\[([]([\s\S]+?)\\[)\]]"
-    # Compiled regex
-    p = re.compile(inline_regex)
-    # Memo to store validity and compile status of latex
-    latex_valid_memo: Dict[str, bool] = dict()
-    latex_compiled_memo: Dict[str, bool] = dict()
-    for text_tag in article.content.find_all(string=True):
-        if keep_verbatim(text_tag):
+    latex_matches: LatexMatches = []
+    # Memo to store the filename each unique piece of latex is compiled to
+    latex_filenames: Dict[str, str] = dict()
+    is_verbatim = cached_keep_verbatim()
+    for text_tag in find_text_tags(article.content):
+        if ("\\(" not in text_tag and "\\[" not in text_tag) or is_verbatim(text_tag):
             continue
 
-        for match in p.finditer(text_tag):
-            # if this is invalid latex, skip
-            if latex_valid_memo.get(match[1], True) == False:
-                continue
-
-            latex = match[1]
-            # just use the hash of the latex for a unique filename, this should probably never collide
-            # NOTE: sha1 is used for speed; we do not use the built-in `hash` function as it is non-deterministic across runs.
-            #       We do NOT need to care about security risks, since we are solely concerned with uniqueness.
-            filename = article.get_pdf_location(
-                hashlib.sha1(match[0].encode("utf-8")).hexdigest()
-            )
-            if match[0] not in latex_compiled_memo:
+        matches = list(LATEX_REGEX.finditer(text_tag))
+        if matches:
+            latex_matches.append((text_tag, matches))
+        for match in matches:
+            if match[0] not in latex_filenames:
+                # just use the hash of the latex for a unique filename, this should probably never collide
+                # NOTE: blake2b is used for speed; we do not use the built-in `hash` function as it is non-deterministic across runs.
+                #       We do NOT need to care about security risks, since we are solely concerned with uniqueness.
+                latex_filenames[match[0]] = article.get_pdf_location(
+                    hashlib.blake2b(
+                        match[0].encode("utf-8"), digest_size=16
+                    ).hexdigest()
+                )
+    return latex_matches, latex_filenames
+
+
+def compile_latex_files(
+    latex_files: Dict[str, Tuple[str, Article]],
+) -> Dict[str, bool]:
+    """Compiles the LaTeX for each filename, along with the article it's from, and returns whether
+    each one compiled.
+    """
+    compiled: Dict[str, bool] = dict()
+    if not latex_files:
+        return compiled
+    # Each compilation spawns pdflatex, so run them side by side
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = {
+            executor.submit(
+                compile_latex_str,
+                # strip the \( \) or \[ \] delimiters
+                latex_src[2:-2],
+                filename,
+                display=(latex_src[1] == "["),
+            ): filename
+            for filename, (latex_src, _) in latex_files.items()
+        }
+        for future in as_completed(futures):
+            filename = futures[future]
+            with report_article_errors(latex_files[filename][1], compile_latex):
                 try:
-                    compile_latex_str(latex, filename, display=(match[0][1] == "["))
-                    latex_valid_memo[latex] = True
-                    latex_compiled_memo[match[0]] = True
+                    future.result()
+                    compiled[filename] = True
                 except subprocess.CalledProcessError:
-                    latex_valid_memo[latex] = False
+                    compiled[filename] = False
                     input("[Enter] to continue...")
-                    continue
+    return compiled
+
+
+def link_latex(
+    article: Article,
+    latex_matches: LatexMatches,
+    latex_filenames: Dict[str, str],
+    compiled: Dict[str, bool],
+):
+    """Replaces each piece of LaTeX that compiled with a link to its PDF."""
+    for text_tag, matches in latex_matches:
+        for match in matches:
+            filename = latex_filenames[match[0]]
+            # if this is invalid latex, skip
+            if not compiled[filename]:
+                continue
+
             link_tag = Tag(name="link", attrs={"href": "file://" + filename + ".pdf"})
             # set the current tag to the new end tag
             text_tag = replace_text_with_tag(
                 match[0], link_tag, text_tag, article=article
             )
-    return article
+
+
+def compile_latex(articles: List[Article]):
+    """Looks through the content of every article for embedded LaTeX and compiles it into
+    PDFs, and adds the proper tags so they show up on import.
+    """
+    # Find all the latex first, so that each unique piece of latex in the issue can be compiled in
+    #  parallel
+    issue_latex: List[Tuple[Article, LatexMatches, Dict[str, str]]] = []
+    for article in articles:
+        with report_article_errors(article, compile_latex):
+            issue_latex.append((article, *find_latex(article)))
+    compiled = compile_latex_files(
+        {
+            filename: (latex_src, article)
+            for article, _, latex_filenames in issue_latex
+            for latex_src, filename in latex_filenames.items()
+        }
+    )
+    for article, latex_matches, latex_filenames in issue_latex:
+        with report_article_errors(article, compile_latex):
+            link_latex(article, latex_matches, latex_filenames, compiled)
+
+
+INLINE_CODE_REGEX = re.compile(r"`([\s\S]+?)`")
 
 
 def replace_inline_code(article: Article) -> Article:
     """Replaces Markdown-style inline code with actual code tags"""
     text_tag: bs4.NavigableString
-    p = re.compile(r"`([\s\S]+?)`")
-    for text_tag in article.content.find_all(string=True):
-        if keep_verbatim(text_tag):
+    is_verbatim = cached_keep_verbatim()
+    for text_tag in find_text_tags(article.content):
+        if "`" not in text_tag or is_verbatim(text_tag):
             continue
 
-        for match in p.finditer(text_tag):
+        for match in INLINE_CODE_REGEX.finditer(text_tag):
             code = match[1]
             code_tag = Tag(name="code")
             code_tag.string = code
@@ -451,23 +728,50 @@ def replace_inline_code(article: Article) -> Article:
     return article
 
 
+# formatting tags that get custom styling when they show up in code
+MANUAL_SYNTAX_HIGHLIGHT_TYPES = {
+    "strong": SyntaxHighlightType.Bold,
+    "b": SyntaxHighlightType.Bold,
+    "em": SyntaxHighlightType.Italic,
+    "i": SyntaxHighlightType.Italic,
+    "u": SyntaxHighlightType.Underline,
+}
+
+
 def convert_manual_syntax_highlighting(article: Article) -> Article:
     """Manually highlighted code gets custom styling"""
-    text_tag: bs4.NavigableString
-    for verb_tag in article.content.find_all(VERBATIM_TAGS):
-        # Highlight strong
-        for strong_tag in verb_tag.find_all(["strong", "b"]):
-            strong_tag.name = get_syntax_highlight_tag_name(SyntaxHighlightType.Bold)
-        # Highlight italicized
-        for em_tag in verb_tag.find_all(["em", "i"]):
-            em_tag.name = get_syntax_highlight_tag_name(SyntaxHighlightType.Italic)
-        # Highlight underlined
-        for u_tag in verb_tag.find_all("u"):
-            u_tag.name = get_syntax_highlight_tag_name(SyntaxHighlightType.Underline)
+    # find all the formatting tags at once, then keep the ones inside verbatim blocks
+    is_verbatim = cached_keep_verbatim()
+    for tag in article.content.find_all(list(MANUAL_SYNTAX_HIGHLIGHT_TYPES)):
+        if is_verbatim(tag):
+            tag.name = get_syntax_highlight_tag_name(
+                MANUAL_SYNTAX_HIGHLIGHT_TYPES[tag.name]
+            )
 
     return article
 
 
+CODE_OPTIONS_REGEX = re.compile(
+    r"""
+    :(\S+?):  # Match the option name
+    [ \t]*    # Allow optional whitespace after option name
+    ([^\n]*)  # Match the option value (optional)
+    """,
+    re.VERBOSE,
+)
+CODE_OPTIONS_BLOCK_REGEX = re.compile(
+    rf"""
+    (?:                               # Look for an option
+        \s*                           # Unlimited leading whitespace
+        {CODE_OPTIONS_REGEX.pattern}  # Match an option
+        \n                            # Enforce newline after each option
+    )+                                # Match multiple options
+    [ \t]*\n+                         # Enforce at least two lines of separation between options block and code
+    """,
+    re.VERBOSE,
+)
+
+
 def format_code_blocks(article: Article) -> Article:
     """Format code blocks by:
     - Using Pygments to highlight code
@@ -475,33 +779,14 @@ def format_code_blocks(article: Article) -> Article:
     - Wrapping code
     """
     pre_tag: bs4.NavigableString
-    options_regex = re.compile(
-        r"""
-    :(\S+?):  # Match the option name
-    [ \t]*    # Allow optional whitespace after option name
-    ([^\n]*)  # Match the option value (optional)
-    """,
-        re.VERBOSE,
-    )
-    options_block_regex = re.compile(
-        rf"""
-    (?:                          # Look for an option
-        \s*                      # Unlimited leading whitespace
-        {options_regex.pattern}  # Match an option
-        \n                       # Enforce newline after each option
-    )+                           # Match multiple options
-    [ \t]*\n+                    # Enforce at least two lines of separation between options block and code
-    """,
-        re.VERBOSE,
-    )
     for pre_tag in article.content.find_all("pre"):
         # Parse options
         pre_contents = pre_tag.decode_contents()
-        options_block = options_block_regex.match(pre_contents)
+        options_block = CODE_OPTIONS_BLOCK_REGEX.match(pre_contents)
         options = {}
         if options_block:
             pre_contents = pre_contents[options_block.end() :]
-            for option_match in options_regex.finditer(
+            for option_match in CODE_OPTIONS_REGEX.finditer(
                 options_block[0]
             ):  # match and save options
                 options[option_match[1]] = (
@@ -520,34 +805,30 @@ def format_code_blocks(article: Article) -> Article:
     return article
 
 
-def replace_ellipses(article: Article) -> Article:
+def replace_ellipses(text: str, article: Article) -> str:
     """Replaces "..." with one single ellipse character"""
-    text_tag: bs4.NavigableString
-    for text_tag in article.content.find_all(string=True):
-        if keep_verbatim(text_tag):
-            continue
+    return text.replace("...", "…")
 
-        new_tag = text_tag.replace("...", "…")
-        text_tag.replace_with(new_tag)
-    return article
+
+VALID_URL_CHARS = "[A-Za-z0-9-._~:/?#\\[\\]@!$&'()*+,;%=]"
+VALID_URL_CHARS_NO_PUNCTUATION = "[A-Za-z0-9-_~/#\\[\\]@$&'()*+%=]"
+# try identifying links by (valid link characters) + (some reasonable TLD) + (more valid chars)
+LINK_REGEX = re.compile(
+    rf"({VALID_URL_CHARS}+(\.com|\.ca|\.org\.gov)"
+    rf"(({VALID_URL_CHARS}*{VALID_URL_CHARS_NO_PUNCTUATION}+)?)?)"
+)
 
 
 # need <link href="{href}">
 def replace_links(article: Article) -> Article:
     """Replaces links in <link></link> tags"""
     text_tag: bs4.NavigableString
-    valid_url_chars = "[A-Za-z0-9-._~:/?#\\[\\]@!$&'()*+,;%=]"
-    valid_url_chars_no_punctuation = "[A-Za-z0-9-_~/#\\[\\]@$&'()*+%=]"
-    prefix = f"{valid_url_chars}+"
-    suffix = f"({valid_url_chars}*{valid_url_chars_no_punctuation}+)?"
-    # try identifying links by (valid link characters) + (some reasonable TLD) + (more valid chars)
-    inline_regex = re.compile(rf"({prefix}(\.com|\.ca|\.org\.gov)({suffix})?)")
-    print(inline_regex)
-    for text_tag in article.content.find_all(string=True):
-        if keep_verbatim(text_tag):
+    is_verbatim = cached_keep_verbatim()
+    for text_tag in find_text_tags(article.content):
+        if is_verbatim(text_tag):
             continue
 
-        for match in inline_regex.finditer(text_tag):
+        for match in LINK_REGEX.finditer(text_tag):
             # Check match for provided numbering -- if it exists, then use it
             link_tag = Tag(name="link", attrs={"href": match[1]})
             link_tag.string = str(match[1])
@@ -558,74 +839,91 @@ def replace_links(article: Article) -> Article:
     return article
 
 
+NUMERIC_RANGE_REGEX = re.compile(r"(?<=\d) ?--? ?(?=\d)")
+# hyphens used as em dashes, with any single spaces around them. A lone spaced hyphen (" - ") is
+#  replaced first, so it can't be split up by a neighbouring "--" or "---" (e.g. "a --- - b")
+EM_DASH_REGEX = re.compile(r" --- |---| -- |--")
+# em dashes, along with single spaces around them, so they can be spaced consistently
+EM_DASH_SPACING_REGEX = re.compile(r" — |—")
+
+
 def replace_dashes(article: Article) -> Article:
     """Replaces hyphens used as spacing, that is, when they are surrounded with spaces,
     with em dashes.
     Also replaces hyphens in numeric ranges with en dashes.
     """
     text_tag: bs4.NavigableString
-    for text_tag in article.content.find_all(string=True):
-        if keep_verbatim(text_tag) or is_link_component(text_tag):
+    is_verbatim = cached_keep_verbatim()
+    is_link_component = cached_is_link_component()
+    for text_tag in find_text_tags(article.content):
+        if is_verbatim(text_tag) or is_link_component(text_tag):
             continue
 
-        new_tag = (
-            re.sub(r"(?<=\d) ?--? ?(?=\d)", "–", text_tag)
-            .replace(" - ", "—")
-            .replace(" --- ", "—")
-            .replace("---", "—")
-            .replace(" -- ", "—")
-            .replace("--", "—")
-            .replace(" — ", "—")
-            .replace("—", " — ")
-        )
+        new_tag = NUMERIC_RANGE_REGEX.sub("–", text_tag)
+        new_tag = EM_DASH_REGEX.sub("—", new_tag.replace(" - ", "—"))
+        # the below spaces are thin spaces
+        new_tag = EM_DASH_SPACING_REGEX.sub(" — ", new_tag)
         text_tag.replace_with(new_tag)
     return article
 
 
-def replace_smart_quotes(s: str):
-    # create an array so we can modify this string
-    char_array = list(s)
+QUOTE_CHARS = ('"', "'")
+QUOTE_REGEX = re.compile("[\"']")
+
 
-    for idx, char in enumerate(char_array):
-        before = None if idx == 0 else char_array[idx - 1]
-        after = None if idx == len(char_array) - 1 else char_array[idx + 1]
-        direction = get_quote_direction(before, after)
-        if char == '"':
-            char_array[idx] = get_double_quote(direction)
-        if char == "'":
-            char_array[idx] = get_single_quote(direction)
+def replace_smart_quote(match: re.Match) -> str:
+    s = match.string
+    idx = match.start()
+    before = None if idx == 0 else s[idx - 1]
+    after = None if idx == len(s) - 1 else s[idx + 1]
+    direction = get_quote_direction(before, after)
+    if match[0] == '"':
+        return get_double_quote(direction)
+    return get_single_quote(direction)
 
-    return "".join(char_array)
+
+def replace_smart_quotes(s: str) -> str:
+    # only visit the quotes themselves, rather than every character
+    return QUOTE_REGEX.sub(replace_smart_quote, s)
 
 
 def add_smart_quotes(article: Article) -> Article:
     """Replaces regular quotes with smart quotes. Works on double and single quotes."""
-    text_tags: List[bs4.NavigableString] = list(article.content.find_all(string=True))
+    text_tags: List[bs4.NavigableString] = find_text_tags(article.content)
     # some hackery here: breaks between text tags might lead to invalid quotes
     # example: "|<em>text</em>|" will make the first quote a right quote, since
     # it's at the end of its text tag.
     # To avoid this, we glue the first character in the following tag
     # and the last character in the previous tag to the current tag.
 
+    is_verbatim = cached_keep_verbatim()
     for idx, tag in enumerate(text_tags):
-        if keep_verbatim(tag):
+        if is_verbatim(tag):
+            continue
+
+        # plain text without quotes has nothing to replace. other string types still go through
+        #  replace_with below, which converts them to plain text
+        if type(tag) is bs4.NavigableString and '"' not in tag and "'" not in tag:
             continue
 
-        before_tag = None if idx == 0 else text_tags[idx - 1]
-        after_tag = None if idx == len(text_tags) - 1 else text_tags[idx + 1]
+        # the glued characters only matter for quotes at the very edges of the tag
+        glue_before = idx != 0 and tag[:1] in QUOTE_CHARS
+        glue_after = idx != len(text_tags) - 1 and tag[-1:] in QUOTE_CHARS
 
-        glued_tag = tag
-        if before_tag is not None:
-            glued_tag = before_tag[-1] + glued_tag
-        if after_tag is not None:
-            glued_tag = glued_tag + after_tag[0]
+        glued_tag = "".join(
+            (
+                text_tags[idx - 1][-1] if glue_before else "",
+                tag,
+                text_tags[idx + 1][0] if glue_after else "",
+            )
+        )
 
         replaced = replace_smart_quotes(glued_tag)
 
         # and remove the characters we glued on
-        if before_tag is not None:
+        if glue_before:
             replaced = replaced[1:]
-        if after_tag is not None:
+        if glue_after:
             replaced = replaced[:-1]
 
         tag.replace_with(replaced)
@@ -633,88 +931,69 @@ def add_smart_quotes(article: Article) -> Article:
     return article
 
 
-def punctuation_in_quotes(article: Article) -> Article:
-    """Ensures punctuation is inside quotation marks"""
-    text_tag: bs4.NavigableString
-    inline_regex = re.compile(r"([’”])([\.\!?;\:\,])")
-    for text_tag in article.content.find_all(string=True):
-        if keep_verbatim(text_tag):
-            continue
+PUNCTUATION_AFTER_QUOTE_REGEX = re.compile(r"([’”])([\.\!?;\:\,])")
 
-        new_tag = text_tag
-        for match in inline_regex.finditer(text_tag):
-            new_tag = new_tag.replace(match[0], match[2] + match[1])
 
-        text_tag.replace_with(new_tag)
-
-    return article
+def punctuation_in_quotes(text: str, article: Article) -> str:
+    """Ensures punctuation is inside quotation marks"""
+    # move each punctuation mark to before the quote it follows
+    return PUNCTUATION_AFTER_QUOTE_REGEX.sub(r"\2\1", text)
+
+
+# characters after which there should only be a single space
+SINGLE_SPACED_CHARS = "A-Za-z0-9" + "À-ÖØ-öø-ÿ" + string.punctuation + "‽"
+# a number of articles come to us with punctuation followed by a double space, where the
+#  first space is an nbsp. maybe it is inserted by a particular text editor?
+#  if we remove them directly, we can stop worrying about nbsps from that point on
+#  (who would be unintentionally adding consecutive nbsps)
+NBSP_SP_PAIRS_REGEX = re.compile(r"(?<=[{}])(\u00A0 )+".format(SINGLE_SPACED_CHARS))
+# matches nbsp-sp pairs along with any spaces after them, as well as all other n-tuple
+#  breaking spaces, so they can all be removed in one pass
+EXTRANEOUS_SPACES_REGEX = re.compile(
+    r"(?<=[{}])(?:(?:\u00A0 )+ *| +)".format(SINGLE_SPACED_CHARS)
+)
 
 
-def remove_extraneous_spaces(article: Article) -> Article:
+def remove_extraneous_spaces(text: str, article: Article) -> str:
     """Removes extraneous spaces after characters."""
-    text_tag: bs4.NavigableString
-    for text_tag in article.content.find_all(string=True):
-        if keep_verbatim(text_tag):
-            continue
-
-        base_alphanumeric = "A-Za-z0-9"
-        accent_characters = "À-ÖØ-öø-ÿ"
-        punctuation = string.punctuation + "‽"
-
-        single_spaced_chars = base_alphanumeric + accent_characters + punctuation
-
-        # a number of articles come to us with punctuation followed by a double space, where the
-        #  first space is an nbsp. maybe it is inserted by a particular text editor?
-        #  if we remove them directly, we can stop worrying about nbsps from that point on
-        #  (who would be unintentionally adding consecutive nbsps)
-        nbsp_sp_pairs = r"(?<=[{}])(\u00A0 )+".format(single_spaced_chars)
-        new_tag = re.sub(nbsp_sp_pairs, " ", text_tag)
-
-        nbsp_sps_found = new_tag != text_tag
-
-        # with the nbsp-sp pairs removed, we can remove all other n-tuple breaking spaces
-        multi_sp = r"(?<=[{}]) +".format(single_spaced_chars)
-        new_tag = re.sub(multi_sp, " ", new_tag)
-
-        text_tag.replace_with(new_tag)
+    new_tag = EXTRANEOUS_SPACES_REGEX.sub(" ", text)
 
-        if nbsp_sps_found or new_tag != text_tag:
-            print(
-                'Removed extraneous spaces in article "'
-                + article.title
-                + '"'
-                + (". Some were nbsp-sp pairs." if nbsp_sps_found else "")
-            )
-    return article
+    if new_tag != text:
+        # only go looking for nbsp-sp pairs when there might be some
+        nbsp_sps_found = (
+            "\u00a0 " in text and NBSP_SP_PAIRS_REGEX.search(text) is not None
+        )
+        print(
+            'Removed extraneous spaces in article "'
+            + article.title
+            + '"'
+            + (". Some were nbsp-sp pairs." if nbsp_sps_found else "")
+        )
+    return new_tag
 
 
 def normalize_newlines(article: Article) -> Article:
     """Normalizes newlines to Unix-style LF"""
     text_tag: bs4.NavigableString
-    for text_tag in article.content.find_all(string=True):
+    for text_tag in find_text_tags(article.content):
         new_tag = text_tag.replace("\r\n", "\n")
         text_tag.replace_with(new_tag)
     return article
 
 
-def hairspace_fractions_out_of_10(article: Article) -> Article:
+OUT_OF_10_REGEX = re.compile(r"([0-9]+)/10")
+
+
+def hairspace_fractions_out_of_10(text: str, article: Article) -> str:
     """For all fractions out of 10, surround the slash with hairspaces to
     break fraction formatting, as this is likely a rating
     """
-    text_tag: bs4.NavigableString
-    inline_regex = re.compile(r"([0-9]+)/10")
-    for text_tag in article.content.find_all(string=True):
-        if keep_verbatim(text_tag):
-            continue
+    # the below spaces are hair spaces
+    return OUT_OF_10_REGEX.sub(r"\1 / 10", text)
 
-        new_tag = text_tag
-        for match in inline_regex.finditer(text_tag):
-            # the below spaces are hair spaces
-            new_tag = new_tag.replace(match[0], f"{match[1]} / 10")
 
-        text_tag.replace_with(new_tag)
-
-    return article
+# a single line break, i.e. not part of a paragraph break
+SINGLE_NEWLINE_REGEX = re.compile("(?<!\n)\n(?!\n)")
 
 
 def replace_newlines(article: Article) -> Article:
@@ -722,8 +1001,9 @@ def replace_newlines(article: Article) -> Article:
     them in InDesign, which will treat newlines as paragraph breaks otherwise.
     """
     text_tag: bs4.NavigableString
-    for text_tag in article.content.find_all(string=True):
-        if not keep_verbatim(text_tag):
+    is_verbatim = cached_keep_verbatim()
+    for text_tag in find_text_tags(article.content):
+        if not is_verbatim(text_tag):
             # Non-verbatim tags must be handled separately, and we must make sure it's not a
             # double line-break (i.e. paragraph break). We also don't replace it if it's
             # immediately before or after a tag
@@ -732,7 +1012,7 @@ def replace_newlines(article: Article) -> Article:
             prev_sibling = text_tag.find_previous_sibling()
             next_sibling = text_tag.find_next_sibling()
             # Split along single line breaks
-            new_tag_builder = re.split("(?<!\n)\n(?!\n)", text_tag)
+            new_tag_builder = SINGLE_NEWLINE_REGEX.split(text_tag)
             # Keep single line breaks that appear next to another tag, by throwing them out and
             # manually placing a newline character
             prefix = ""
@@ -750,22 +1030,26 @@ def replace_newlines(article: Article) -> Article:
     return article
 
 
+FOOTNOTE_REGEX = re.compile(r"\[([0-9§]*)\]")
+FOOTNOTE_NUMBER_REGEX = re.compile(r"([0-9])")
+
+
 def add_footnotes(article: Article) -> Article:
     """Replaces footnotes in <sup></sup> tags, [\\d] format, or *, **, etc."""
     text_tag: bs4.NavigableString
-    footnote_regex = re.compile(r"\[([0-9§]*)\]")
     footnote_counter = 1  # is the expected number of the next footnote
-    for text_tag in article.content.find_all(string=True):
-        if keep_verbatim(text_tag):
+    is_verbatim = cached_keep_verbatim()
+    for text_tag in find_text_tags(article.content):
+        if "[" not in text_tag or is_verbatim(text_tag):
             continue
 
-        for match in footnote_regex.finditer(text_tag):
+        for match in FOOTNOTE_REGEX.finditer(text_tag):
             # Check match for provided numbering -- if it exists, then use it
             footnote_num = footnote_counter
             footnote_contents = match[1]
             if len(footnote_contents):
                 if "§" in footnote_contents:
-                    first_number = re.search(r"([0-9])", footnote_contents)
+                    first_number = FOOTNOTE_NUMBER_REGEX.search(footnote_contents)
                     print(footnote_contents, first_number)
                     footnote_num = int(first_number[0])
                 else:
@@ -781,21 +1065,13 @@ def add_footnotes(article: Article) -> Article:
     return article
 
 
-def footnote_after_punctuation(article: Article) -> Article:
-    """Replaces footnotes in <sup></sup> tags, [\\d] format, or *, **, etc."""
-    text_tag: bs4.NavigableString
-    inline_regex = re.compile(r"(\[[§\d]*\])([\.,!?;:])")
-    for text_tag in article.content.find_all(string=True):
-        if keep_verbatim(text_tag):
-            continue
+FOOTNOTE_BEFORE_PUNCTUATION_REGEX = re.compile(r"(\[[§\d]*\])([\.,!?;:])")
 
-        new_tag = text_tag
-        for match in inline_regex.finditer(text_tag):
-            new_tag = new_tag.replace(match[0], match[2] + match[1])
 
-        text_tag.replace_with(new_tag)
-
-    return article
+def footnote_after_punctuation(text: str, article: Article) -> str:
+    """Replaces footnotes in <sup></sup> tags, [\\d] format, or *, **, etc."""
+    # move each punctuation mark to before the footnote it follows
+    return FOOTNOTE_BEFORE_PUNCTUATION_REGEX.sub(r"\2\1", text)
 
 
 def process_captions(article: Article) -> Article:
@@ -823,15 +1099,31 @@ def process_captions(article: Article) -> Article:
     return article
 
 
+BOLD_TAGS = ("b", "strong")
+ITALIC_TAGS = ("i", "em")
+
+
 def convert_emphasis_2(article: Article) -> Article:
     """Converts nested bold/italic tags into a single <em2> tag."""
-    for b in article.content.find_all(["b", "strong"]):
-        for i in b.find_all(["i", "em"]):
-            i.name = "em2"
 
-    for i in article.content.find_all(["i", "em"]):
-        for b in i.find_all(["b", "strong"]):
-            b.name = "em2"
+    def convert_nested_emphasis(tag: Tag, in_bold: bool, in_italic: bool):
+        # in_italic is only set by italics that aren't themselves inside bold, since those get
+        #  converted instead of the bold inside them
+        if tag.name in BOLD_TAGS:
+            if in_italic:
+                tag.name = "em2"
+            in_bold = True
+        elif tag.name in ITALIC_TAGS:
+            if in_bold:
+                tag.name = "em2"
+            else:
+                in_italic = True
+
+        for child in tag.children:
+            if isinstance(child, Tag):
+                convert_nested_emphasis(child, in_bold, in_italic)
+
+    convert_nested_emphasis(article.content, False, False)
 
     return article
 
@@ -845,6 +1137,13 @@ def convert_profquotes(article: Article) -> Article:
     return article
 
 
+# tags whose <li> children are replaced with newlines
+LIST_TAGS = ("ul", "ol", "profquotes")
+# names nested lists can have, which count towards how deeply a list is nested
+UL_TAGS = ("ul", "ul2", "ul3", "ul4", "ul5")
+OL_TAGS = ("ol", "ol2", "ol3")
+
+
 def fix_lists(article: Article) -> Article:
     """
     Converts HTML lists into a format friendlier for InDesign.
@@ -854,7 +1153,8 @@ def fix_lists(article: Article) -> Article:
     its own tag (ul2, ul3, etc.) For top-level elements, we also give the first item in each
     list its own tag (ul_first, ol_first) for special formatting.
     """
-    for list_tag in article.content.find_all(["ul", "ol", "profquotes"]):
+
+    def flatten_list(list_tag: Tag):
         new_children = []
         for child in list_tag.children:
             if isinstance(child, str):
@@ -865,64 +1165,97 @@ def fix_lists(article: Article) -> Article:
         list_tag.clear()
         list_tag.extend(new_children[:-1])
 
-    for ul in article.content.find_all("ul"):
-        parents = [parent.name for parent in ul.parents]
-        level = (
-            parents.count("ul")
-            + parents.count("ul2")
-            + parents.count("ul3")
-            + parents.count("ul4")
-            + parents.count("ul5")
-            + 1
-        )
-        if 1 < level <= 5:
-            new_tag_name = f"ul{level}"
-            ul.name = new_tag_name
+    def fix_nested_lists(tag: Tag, ul_level: int, ol_level: int):
+        # the levels are the number of lists of each kind that this tag is nested in
+        if tag.name in LIST_TAGS:
+            flatten_list(tag)
+
+        if tag.name == "ul":
+            if 0 < ul_level < 5:
+                tag.name = f"ul{ul_level + 1}"
+            if ul_level == 0:
+                tag.contents[0].wrap(Tag(name="ul_first"))
+        elif tag.name == "ol":
+            if 0 < ol_level < 3:
+                tag.name = f"ol{ol_level + 1}"
+            if ol_level == 0:
+                tag.contents[0].wrap(Tag(name="ol_first"))
+
+        if tag.name in UL_TAGS:
+            ul_level += 1
+        elif tag.name in OL_TAGS:
+            ol_level += 1
+
+        for child in list(tag.children):
+            if isinstance(child, Tag):
+                fix_nested_lists(child, ul_level, ol_level)
+
+    # fix every list in a single descent, passing down how deeply nested we are rather than
+    #  counting list ancestors for each list
+    fix_nested_lists(article.content, 0, 0)
 
-        if level == 1:
-            ul.contents[0].wrap(Tag(name="ul_first"))
+    return article
 
-    for ol in article.content.find_all("ol"):
-        parents = [parent.name for parent in ol.parents]
-        level = parents.count("ol") + parents.count("ol2") + parents.count("ol3") + 1
-        if 1 < level <= 3:
-            new_tag_name = f"ol{level}"
-            ol.name = new_tag_name
 
-        if level == 1:
-            ol.contents[0].wrap(Tag(name="ol_first"))
+def for_each_article(
+    process: Callable[[Article], Article],
+) -> Callable[[List[Article]], None]:
+    """Turns a post-process step for a single article into an issue step that runs it on every
+    article in turn.
+    """
 
-    return article
+    def run(articles: List[Article]):
+        articles[:] = [catch_process_errors(article, process) for article in articles]
 
+    run.__name__ = process.__name__
+    return run
 
-"""POST_PROCESS is a list of functions that take Article instances and return Article instances.
 
-For each article we parse, every function in this list will be applied to it in order, and the
-result saved back to the article list.
+"""ISSUE_PROCESS is a list of functions that take the list of every article in the issue, and
+change the articles in place.
 
-Use this to make any changes to articles you need before export, as well as to generate assets.
+These run first, in the main process, one step at a time over the whole issue. Steps that need to
+prompt the user belong here, as do steps that share a pool of workers across the whole issue, like
+downloading images and compiling LaTeX. Wrap a step for a single article in for_each_article to
+run it here.
 """
-POST_PROCESS: List[Callable[[Article], Article]] = [
-    process_captions,
-    normalize_newlines,
-    convert_imgur_embeds,
+ISSUE_PROCESS: List[Callable[[List[Article]], None]] = [
+    for_each_article(process_captions),
+    for_each_article(normalize_newlines),
+    for_each_article(convert_imgur_embeds),
     download_images,
     compile_latex,
+]
+
+"""POST_PROCESS is a list of functions that take Article instances and return Article instances.
+Consecutive passes that only rewrite text can be combined with text_passes, so that they share a
+single traversal of the article.
+
+Once ISSUE_PROCESS is done (i.e. everything up to and including compile_latex), each article is
+sent to a worker process, which applies every function in this list to it in order and sends back
+the exported article. Several articles are processed at once, and workers can't prompt the user:
+input() raises EOFError there, so anything that needs to ask belongs in ISSUE_PROCESS.
+
+Use this to make any changes to articles you need before export.
+"""
+POST_PROCESS: List[Callable[[Article], Article]] = [
     replace_inline_code,
     convert_manual_syntax_highlighting,
     format_code_blocks,
     replace_newlines,
-    replace_ellipses,
+    text_passes(replace_ellipses),
     replace_links,
     replace_dashes,
     add_smart_quotes,
-    punctuation_in_quotes,
-    remove_extraneous_spaces,
-    footnote_after_punctuation,
+    text_passes(
+        punctuation_in_quotes,
+        remove_extraneous_spaces,
+        footnote_after_punctuation,
+    ),
     add_footnotes,
     convert_emphasis_2,
     convert_profquotes,
-    hairspace_fractions_out_of_10,
+    text_passes(hairspace_fractions_out_of_10),
     fix_lists,
 ]
 
@@ -934,12 +1267,11 @@ def create_asset_dirs():
         os.makedirs(os.path.join(ASSET_DIR, "pdf"))
 
 
-def catch_process_errors(
-    article: Article,
-    process: Callable[[Article], Article],
-):
+@contextlib.contextmanager
+def report_article_errors(article: Article, process: Callable) -> Iterator[None]:
+    """Names the article and step in the output if anything in the block fails."""
     try:
-        return process(article)
+        yield
     except Exception as e:
         print(
             colorama.Fore.RED
@@ -952,41 +1284,128 @@ def catch_process_errors(
         raise e
 
 
-def write_issue(root: Element, output_file_path: str, current_dir_path: str):
-    # do some processing first
-    # Remove extraneous lines
-    transformed = "\n".join(
-        [
-            line
-            for line in html.unescape(
-                ElementTree.tostring(root, encoding="unicode")
-            ).split("\n")
-            if line.strip() != ""
-        ]
-    )
-    # Separate articles cleanly
-    transformed = "</article>\n<article>".join(
-        [article for article in transformed.split("</article><article>")]
-    )
-    # Separate title, subtitle, and content cleanly
-    transformed = "</title>\n<content>".join(
-        [article for article in transformed.split("</title><content>")]
-    )
-    transformed = "</title>\n<subtitle>".join(
-        [article for article in transformed.split("</title><subtitle>")]
-    )
-    transformed = "</subtitle>\n<content>".join(
-        [article for article in transformed.split("</subtitle><content>")]
+def catch_process_errors(
+    article: Article,
+    process: Callable[[Article], Article],
+) -> Article:
+    with report_article_errors(article, process):
+        return process(article)
+
+
+def post_process_in_worker(article: Article) -> Tuple[bool, Element]:
+    """Run the remaining passes and export the article, so only its XML comes back."""
+    for process in POST_PROCESS:
+        article = catch_process_errors(article, process)
+    return article.is_secondary_article(), article.to_xml_element()
+
+
+def serialize_element(element: Element) -> str:
+    """Serializes one of the <issue>, <article>, <title>, <subtitle> or <content> elements built by
+    to_xml_element. These never have attributes or tail text, so neither is written out. Text is
+    written out as-is, since the text of our elements is already escaped markup, and escaping it
+    again would only have to be undone afterwards.
+    """
+    if not element.text and len(element) == 0:
+        return f"<{element.tag} />"
+    return "".join(
+        (
+            f"<{element.tag}>",
+            element.text or "",
+            *(serialize_element(child) for child in element),
+            f"</{element.tag}>",
+        )
     )
-    # Remove extraneous items from beginning and end of lists
-    transformed = "<ul>".join([thing for thing in transformed.split("<ul>\n")])
-    transformed = "</ul>".join([thing for thing in transformed.split("\n</ul>")])
-    transformed = "<ol>".join([thing for thing in transformed.split("<ol>\n")])
-    transformed = "</ol>".join([thing for thing in transformed.split("\n</ol>")])
 
+
+ARTICLE_FORMAT_REGEX = re.compile(
+    r"""
+    (?P<list_start><[uo]l>)\n(?:[^\S\n]*\n)*        # Newline at the beginning of a list
+    | \n(?:[^\S\n]*\n)*(?P<list_end></[uo]l>)       # Newline at the end of a list
+    | (?P<blank_lines>\n)(?:[^\S\n]*\n)+             # Extraneous lines
+    | (?P<heading_end></title>(?=<content>|<subtitle>)|</subtitle>(?=<content>))  # Heading tags
+    """,
+    re.VERBOSE,
+)
+
+
+def format_article_match(match: re.Match) -> str:
+    if match["heading_end"]:
+        # Separate title, subtitle, and content cleanly
+        return match["heading_end"] + "\n"
+    # Remove extraneous lines, including any at the beginning and end of lists
+    return match[match.lastgroup]
+
+
+def format_article_xml(transformed: str) -> str:
+    """Tidies up the serialized XML of a single article."""
+    return ARTICLE_FORMAT_REGEX.sub(format_article_match, transformed)
+
+
+def write_issue(root: Element, output_file_path: str, current_dir_path: str):
     os.chdir(current_dir_path)
     with open(output_file_path, "w", encoding="utf-8") as output_file:
-        output_file.write(transformed)
+        if len(root) == 0:
+            output_file.write(serialize_element(root))
+            return
+
+        # write out one article at a time, rather than building the whole issue in memory
+        output_file.write(f"<{root.tag}>")
+        for index, article_tag in enumerate(root):
+            # Separate articles cleanly
+            if index > 0:
+                output_file.write("\n")
+            output_file.write(format_article_xml(serialize_element(article_tag)))
+        output_file.write(f"</{root.tag}>")
+
+
+def main(issue: str, xml_dump: str, xml_output: str, assets: str):
+    """Exports the articles for issue from the XML dump at xml_dump, writing the output files with
+    the suffix xml_output and the generated assets to the folder assets.
+    """
+    global ASSET_DIR, OUTPUT_FILE_SUFFIX, CURRENT_DIR
+    CURRENT_DIR = os.getcwd()
+    if os.path.isabs(assets):
+        ASSET_DIR = assets
+    else:
+        ASSET_DIR = os.path.join(CURRENT_DIR, assets)
+    shutil.rmtree(ASSET_DIR, ignore_errors=True)
+    create_asset_dirs()
+    OUTPUT_FILE_SUFFIX = xml_output
+
+    print("Parsing and filtering articles...", flush=True)
+    articles = filter_articles(xml_dump, issue)
+    articles.sort(key=lambda article: article.get_length())
+
+    print("Post-processing articles...", flush=True)
+    for process in ISSUE_PROCESS:
+        print(f"Post-process pass: {process.__name__}", flush=True)
+        process(articles)
+
+    # articles are independent of each other, so the remaining steps can run on several at once
+    print("Post-processing articles in worker processes...", flush=True)
+    with ProcessPoolExecutor() as executor:
+        exported = executor.map(post_process_in_worker, articles)
+        # the soup trees are no longer needed once they have been sent to the workers
+        del articles
+
+        main_articles_root = Element("issue")
+        secondary_articles_root = Element("issue")
+        for is_secondary, article_element in exported:
+            if is_secondary:
+                secondary_articles_root.append(article_element)
+            else:
+                main_articles_root.append(article_element)
+
+    main_articles_output_file = "main_articles_" + OUTPUT_FILE_SUFFIX
+    secondary_articles_output_file = "secondary_articles_" + OUTPUT_FILE_SUFFIX
+    print(f"Writing main articles to {main_articles_output_file}...", flush=True)
+    write_issue(main_articles_root, main_articles_output_file, CURRENT_DIR)
+    print(
+        f"Writing secondary articles to {secondary_articles_output_file}...", flush=True
+    )
+    write_issue(secondary_articles_root, secondary_articles_output_file, CURRENT_DIR)
+
+    print("Issues written.")
 
 
 if __name__ == "__main__":
@@ -1004,49 +1423,8 @@ if __name__ == "__main__":
         "-a", "--assets", help="a folder to store asset files to", default="assets"
     )
     args = parser.parse_args()
-    CURRENT_DIR = os.getcwd()
-    if os.path.isabs(args.assets):
-        ASSET_DIR = args.assets
-    else:
-        ASSET_DIR = os.path.join(CURRENT_DIR, args.assets)
-    shutil.rmtree(ASSET_DIR, ignore_errors=True)
-    create_asset_dirs()
-    OUTPUT_FILE_SUFFIX = args.xml_output
     if not os.path.isfile(args.xml_dump):
         print(f"{args.xml_dump} does not exist.")
         exit(1)
 
-    print("Parsing XML...", flush=True)
-    tree = ElementTree.parse(args.xml_dump)
-
-    print("Filtering articles...", flush=True)
-    articles = filter_articles(tree, args.issue)
-    articles.sort(key=lambda article: article.get_length())
-
-    print("Post-processing articles...", flush=True)
-    for process in POST_PROCESS:
-        print(f"Preparing post-process pass: {process.__name__}", flush=True)
-        articles = map(
-            lambda article, process=process: catch_process_errors(article, process),
-            articles,
-        )
-
-    print(f"Post-processing...", flush=True)
-    main_articles_root = Element("issue")
-    secondary_articles_root = Element("issue")
-    for article in articles:
-        if article.is_secondary_article():
-            secondary_articles_root.append(article.to_xml_element())
-        else:
-            main_articles_root.append(article.to_xml_element())
-
-    main_articles_output_file = "main_articles_" + OUTPUT_FILE_SUFFIX
-    secondary_articles_output_file = "secondary_articles_" + OUTPUT_FILE_SUFFIX
-    print(f"Writing main articles to {main_articles_output_file}...", flush=True)
-    write_issue(main_articles_root, main_articles_output_file, CURRENT_DIR)
-    print(
-        f"Writing secondary articles to {secondary_articles_output_file}...", flush=True
-    )
-    write_issue(secondary_articles_root, secondary_articles_output_file, CURRENT_DIR)
-
-    print("Issues written.")
+    main(args.issue, args.xml_dump, args.xml_output, args.assets)
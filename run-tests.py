@@ -1,9 +1,13 @@
+import argparse
+import contextlib
 import os
-import subprocess
+import traceback
 import xml.etree.ElementTree as ET
 
 import colorama
 
+import prepress
+
 """
 Get all tests from the /tests/ directory, run them, and compare to expected outputs
 
@@ -21,22 +25,31 @@ def print_difference(exp, act):
 
 
 def elements_equal(exp, act):
-    """source: https://stackoverflow.com/questions/7905380/testing-equivalence-of-xml-etree-elementtree"""
-    if exp.tag != act.tag:
-        print_difference(exp.tag, act.tag)
-        return False
-    if exp.text != act.text:
-        print_difference(exp.text, act.text)
-        return False
-    if (exp.tail or "").strip() != (act.tail or "").strip():
-        print_difference((exp.tail or "").strip(), (act.tail or "").strip())
-        return False
-    if exp.attrib != act.attrib:
-        print_difference(exp.attrib, act.attrib)
-        return False
-    if len(exp) != len(act):
-        return False
-    return all(elements_equal(c1, c2) for c1, c2 in zip(exp, act))
+    """source: https://stackoverflow.com/questions/7905380/testing-equivalence-of-xml-etree-elementtree
+
+    Walks the trees with an explicit stack rather than recursing, so deeply nested content can't
+    hit the recursion limit.
+    """
+    stack = [(exp, act)]
+    while stack:
+        exp, act = stack.pop()
+        if exp.tag != act.tag:
+            print_difference(exp.tag, act.tag)
+            return False
+        if exp.text != act.text:
+            print_difference(exp.text, act.text)
+            return False
+        if (exp.tail or "").strip() != (act.tail or "").strip():
+            print_difference((exp.tail or "").strip(), (act.tail or "").strip())
+            return False
+        if exp.attrib != act.attrib:
+            print_difference(exp.attrib, act.attrib)
+            return False
+        if len(exp) != len(act):
+            return False
+        # push the children in reverse, so they're compared in document order
+        stack.extend(reversed(list(zip(exp, act))))
+    return True
 
 
 def handle_test_failure(test_name, expected_out, actual_out):
@@ -71,8 +84,8 @@ def handle_test_failure(test_name, expected_out, actual_out):
     exit()
 
 
-def run_test(test_name: str):
-    """Runs the given test"""
+def run_test(test_name: str, verbose: bool = False):
+    """Runs the given test, showing prepress's own output if verbose is set"""
     print(f"Running test: {test_name}")
 
     directory = os.path.join(test_directory, test_name)
@@ -85,16 +98,18 @@ def run_test(test_name: str):
         directory, "secondary_articles_issue.xml"
     )
 
-    prepress_result = subprocess.run(
-        ["python", os.path.join(os.getcwd(), "prepress.py"), "v1xxiy", infile],
-        stdout=subprocess.DEVNULL,
-    )
-
-    if prepress_result.returncode != 0:
+    # run prepress in this process, so its imports are only paid for once
+    try:
+        with open(os.devnull, "w") as devnull, (
+            contextlib.nullcontext() if verbose else contextlib.redirect_stdout(devnull)
+        ):
+            prepress.main("v1xxiy", infile, "issue.xml", "assets")
+    except Exception:
+        traceback.print_exc()
         print(colorama.Fore.YELLOW)
         print(f"prepress failed to run test: {test_name}")
         print(
-            "There is likely debug output above. If not, try running the test file directly"
+            "There is likely debug output above. If not, try running the tests with --verbose"
             + colorama.Fore.RESET
         )
         exit()
@@ -131,17 +146,24 @@ def run_test(test_name: str):
         )
 
 
-colorama.init()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run prepress against the test cases")
+    parser.add_argument(
+        "--verbose", action="store_true", help="show prepress's output for each test"
+    )
+    args = parser.parse_args()
+
+    colorama.init()
 
-test_directory = os.path.join(os.getcwd(), "test-cases")
+    test_directory = os.path.join(os.getcwd(), "test-cases")
 
-test_suites = [
-    d
-    for d in os.listdir(test_directory)
-    if os.path.isdir(os.path.join(test_directory, d))
-]
+    test_suites = [
+        d
+        for d in os.listdir(test_directory)
+        if os.path.isdir(os.path.join(test_directory, d))
+    ]
 
-for directory in test_suites:
-    run_test(directory)
+    for directory in test_suites:
+        run_test(directory, args.verbose)
 
-print("\033[92mAll tests passed :)\033[0m")
+    print("\033[92mAll tests passed :)\033[0m")
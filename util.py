@@ -1,6 +1,6 @@
-import functools
+from typing import Callable, Dict, List, Optional, Tuple
 
-from bs4 import Tag
+from bs4 import NavigableString, PageElement, Tag
 
 # Unicode LINE SEPARATOR character
 LINE_SEPARATOR = "\u2028"
@@ -10,16 +10,50 @@ VERBATIM_TAGS = ("pre", "code")
 LINK_TAG = "link"
 
 
-def keep_verbatim(tag: Tag) -> bool:
-    return tag.name in VERBATIM_TAGS or any(
-        filter(lambda t: t.name in VERBATIM_TAGS, tag.parents)
-    )
+def find_text_tags(tag: Tag) -> List[NavigableString]:
+    """Returns the same text tags as tag.find_all(string=True), without going through bs4's
+    generic matching for every element in the tree. Like find_all, this skips the empty strings
+    left behind when text is split around a new tag.
+    """
+    return [
+        element
+        for element in tag.descendants
+        if isinstance(element, NavigableString) and element
+    ]
 
 
-def is_link_component(tag: Tag) -> bool:
-    return tag.name == LINK_TAG or any(
-        filter(lambda t: t.name == LINK_TAG, tag.parents)
-    )
+def cached_ancestor_check(names: Tuple[str, ...]) -> Callable[[PageElement], bool]:
+    """Returns a function that checks whether an element is, or is inside, a tag with one of the
+    given names. It remembers its answer for each tag it visits, so text tags sharing ancestors
+    don't each walk all the way up the tree. Tags can be renamed or moved between passes, so a new
+    one should be made for each traversal.
+    """
+    # keyed by id, since tags hash by their contents; the tag is kept to hold on to its id
+    checked_tags: Dict[int, Tuple[Tag, bool]] = {}
+
+    def check(tag: Optional[PageElement]) -> bool:
+        if tag is None:
+            return False
+        if isinstance(tag, NavigableString):
+            return check(tag.parent)
+        cached = checked_tags.get(id(tag))
+        if cached is not None:
+            return cached[1]
+        result = tag.name in names or check(tag.parent)
+        checked_tags[id(tag)] = (tag, result)
+        return result
+
+    return check
+
+
+def cached_keep_verbatim() -> Callable[[PageElement], bool]:
+    """Returns a cached check for whether an element is, or is inside, a verbatim tag."""
+    return cached_ancestor_check(VERBATIM_TAGS)
+
+
+def cached_is_link_component() -> Callable[[PageElement], bool]:
+    """Returns a cached check for whether an element is, or is inside, a link tag."""
+    return cached_ancestor_check((LINK_TAG,))
 
 
 __html_escape_lut = str.maketrans(
@@ -27,6 +61,5 @@ __html_escape_lut = str.maketrans(
 )
 
 
-@functools.lru_cache()
-def html_escape(value):
+def html_escape(value: str) -> str:
     return value.translate(__html_escape_lut)